@@ -1,60 +1,161 @@
 import streamlit as st
-import pandas as pd
-import folium
-from folium.plugins import HeatMap
-from streamlit_folium import st_folium
-from oauth2client.service_account import ServiceAccountCredentials
-import gspread
-from datetime import datetime
-import itertools
-import time
-import math
+import hmac
 
 st.set_page_config(page_title="Chicago Sales Map", layout="wide")
 
-SHEET_NAME = "Chicago_Heatmap_Data"
-
 # -----------------------------
 # PASSWORD PROTECTION
 # -----------------------------
 st.sidebar.header("Login")
 password = st.sidebar.text_input("Enter password", type="password")
 
-if password != st.secrets["app_password"]:
+if not hmac.compare_digest(password.encode(), st.secrets["app_password"].encode()):
     st.error("Unauthorized. Please enter the correct password.")
     st.stop()
 
+# Everything else is only imported once the visitor is authorized
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import folium
+from folium.elements import JSCSSMixin
+from folium.plugins import FastMarkerCluster, HeatMap
+from jinja2 import Template
+from streamlit_folium import st_folium
+from streamlit_autorefresh import st_autorefresh
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+import google_auth_httplib2
+import httplib2
+import requests
+from shapely.geometry import mapping, shape
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+import itertools
+import json
+import orjson
+import math
+
+SHEET_NAME = "Chicago_Heatmap_Data"
+CHICAGO_BOUNDARY_URL = "https://data.cityofchicago.org/resource/ewy2-6yfk.geojson"
+NEIGHBORHOODS_URL = "https://raw.githubusercontent.com/blackmad/neighborhoods/master/chicago.geojson"
+
+# Local copy of the sheet so cold starts don't wait on the Sheets API
+DATA_CACHE_PATH = Path("data.parquet")
+# How often to ask Drive whether the sheet changed (a tiny metadata call)
+REVISION_TTL = 60
+
+# Queued sidebar submissions are written automatically once this many pile up
+PENDING_FLUSH_SIZE = 20
+
+# Rows shown in the "Current Data" table unless the user asks for more
+DEFAULT_TABLE_ROWS = 200
+
 # -----------------------------
 # GOOGLE SHEETS CONNECTION
 # -----------------------------
 @st.cache_resource
-def connect_gsheet():
-    scope = ["https://spreadsheets.google.com/feeds",
+def gcp_credentials():
+    scope = ["https://www.googleapis.com/auth/spreadsheets",
              "https://www.googleapis.com/auth/drive"]
 
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(
-        dict(st.secrets["gcp_service_account"]), scope
+    return service_account.Credentials.from_service_account_info(
+        dict(st.secrets["gcp_service_account"]), scopes=scope
     )
-    client = gspread.authorize(creds)
-    return client.open(SHEET_NAME).sheet1
 
-sheet = connect_gsheet()
+def authorized_http():
+    return google_auth_httplib2.AuthorizedHttp(gcp_credentials(), http=httplib2.Http())
+
+def build_request(http, *args, **kwargs):
+    """Give every request its own Http: the services are shared by all session threads
+    and httplib2 is not thread-safe"""
+    return HttpRequest(authorized_http(), *args, **kwargs)
+
+@st.cache_resource
+def connect_sheets_service():
+    """Sheets API v4 client, used for reads and appends"""
+    return build("sheets", "v4", http=authorized_http(), requestBuilder=build_request, cache_discovery=False)
+
+@st.cache_resource
+def connect_drive_service():
+    """Drive API v3 client, used to find the sheet and read its modifiedTime"""
+    return build("drive", "v3", http=authorized_http(), requestBuilder=build_request, cache_discovery=False)
+
+sheets_service = connect_sheets_service()
+drive_service = connect_drive_service()
+
+@st.cache_resource
+def locate_sheet():
+    """Spreadsheet ID and first worksheet title of SHEET_NAME"""
+    files = drive_service.files().list(
+        q=f"name = '{SHEET_NAME}' and mimeType = 'application/vnd.google-apps.spreadsheet' and trashed = false",
+        fields="files(id)",
+        pageSize=1,
+        supportsAllDrives=True,
+        includeItemsFromAllDrives=True
+    ).execute()["files"]
+    if not files:
+        raise FileNotFoundError(f"Spreadsheet '{SHEET_NAME}' not found or not shared with the service account")
+    spreadsheet_id = files[0]["id"]
+    meta = sheets_service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id, fields="sheets.properties.title"
+    ).execute()
+    return spreadsheet_id, meta["sheets"][0]["properties"]["title"]
+
+spreadsheet_id, worksheet_title = locate_sheet()
 
 # -----------------------------
 # DATA LOADING
 # -----------------------------
-@st.cache_data(ttl=300)
-def load_data():
-    """Pull fresh data from Google Sheets"""
-    vals = sheet.get_all_values()
+SHEET_COLUMNS = ["Name","Latitude","Longitude","Sales","AddedBy","Timestamp","Category"]
+
+# The fetched sheet, its Parquet copy and locally written rows all use this one schema, so they
+# concatenate whatever pandas/pyarrow infer (e.g. large_string vs string, or null for an empty sheet)
+TABLE_SCHEMA = pa.schema([
+    ("Name", pa.string()),
+    ("Latitude", pa.float64()),
+    ("Longitude", pa.float64()),
+    ("Sales", pa.float64()),
+    ("AddedBy", pa.string()),
+    ("Timestamp", pa.string()),
+    ("Category", pa.dictionary(pa.int32(), pa.string())),
+])
+
+def serial_to_iso(value):
+    """ISO-8601 text of a Sheets date serial (days since 1899-12-30); other values are returned as-is"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return pd.to_datetime(value, unit="D", origin="1899-12-30").round("s").isoformat()
+    return value
+
+def frame_from_values(vals):
+    """Typed DataFrame from a header row followed by data rows"""
     if not vals:
-        return pd.DataFrame(columns=["Name","Latitude","Longitude","Sales","AddedBy","Timestamp","Category"])
-    df = pd.DataFrame(vals[1:], columns=vals[0])
-    df["Sales"] = pd.to_numeric(df["Sales"], errors="coerce")
-    df["Latitude"] = pd.to_numeric(df["Latitude"], errors="coerce")
-    df["Longitude"] = pd.to_numeric(df["Longitude"], errors="coerce")
+        return pd.DataFrame(columns=SHEET_COLUMNS)
+    # values.get leaves out trailing empty cells; pad rows back to the header so a blank
+    # last column (Category) reads as "" instead of missing
+    width = len(vals[0])
+    df = pd.DataFrame([row + [""] * (width - len(row)) for row in vals[1:]], columns=vals[0])
+    # UNFORMATTED_VALUE returns hand-entered numbers/dates as numbers even in text columns;
+    # Arrow needs one type per column. Dates typed into the sheet come back as day serials,
+    # so turn those into the same ISO text make_row writes
+    if "Timestamp" in df.columns:
+        df["Timestamp"] = df["Timestamp"].map(serial_to_iso)
+    for col in ("AddedBy", "Timestamp", "Category"):
+        if col in df.columns:
+            df[col] = df[col].astype("string")
+    # Kept as float64: float32's ~7 significant digits would round sales totals and
+    # drop the sixth decimal of a coordinate
+    df["Sales"] = pd.to_numeric(df["Sales"], errors="coerce").astype("float64")
+    df["Latitude"] = pd.to_numeric(df["Latitude"], errors="coerce").astype("float64")
+    df["Longitude"] = pd.to_numeric(df["Longitude"], errors="coerce").astype("float64")
     if "Timestamp" in df.columns:
-        df["Timestamp"] = pd.to_datetime(df["Timestamp"], errors="coerce")
+        # Left as the ISO-8601 strings make_row writes; they sort and compare correctly as text
+        df["Timestamp"] = df["Timestamp"].replace("", pd.NA)
 
     # Normalize categories for consistency
     df["Category"] = df["Category"].replace({
@@ -62,17 +163,94 @@ def load_data():
         "Grocery": "Grocery/Liquor Store"
     })
 
-    return df.dropna(subset=["Latitude","Longitude"])
+    # Dictionary-encode the repeated category labels and keep names in Arrow storage
+    df["Category"] = df["Category"].astype("category")
+    df["Name"] = df["Name"].astype("string[pyarrow]")
 
-def append_row(name, lat, lng, sales, category, added_by):
-    sheet.append_row([name, float(lat), float(lng), float(sales), added_by, datetime.utcnow().isoformat(), category])
+    return df.dropna(subset=["Latitude","Longitude"])
 
-# Initialize session state for data
-if "df" not in st.session_state:
-    with st.spinner("Loading data..."):
-        st.session_state.df = load_data()
+def frame_to_table(df):
+    """Arrow table of a frame from frame_from_values, in TABLE_SCHEMA"""
+    return pa.Table.from_pandas(df.reindex(columns=TABLE_SCHEMA.names), schema=TABLE_SCHEMA, preserve_index=False)
 
-df = st.session_state.df
+def fetch_sheet_data():
+    """Pull fresh data from Google Sheets"""
+    vals = sheets_service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id,
+        range=f"'{worksheet_title}'!A:G",
+        valueRenderOption="UNFORMATTED_VALUE",
+        dateTimeRenderOption="SERIAL_NUMBER"
+    ).execute().get("values", [])
+    return frame_from_values(vals)
+
+@st.cache_data(ttl=REVISION_TTL)
+def sheet_revision():
+    """Drive modifiedTime of the spreadsheet; changes whenever its contents do"""
+    return drive_service.files().get(fileId=spreadsheet_id, fields="modifiedTime", supportsAllDrives=True).execute()["modifiedTime"]
+
+@st.cache_resource(max_entries=2)
+def load_table(revision):
+    """Sheet data for a given revision as one immutable Arrow table shared by every session,
+    read from the local Parquet copy when it was saved at that revision"""
+    try:
+        cached = pq.read_schema(DATA_CACHE_PATH)
+        # A copy written with an older schema (e.g. float32 columns) is refetched, not cast
+        if (cached.metadata or {}).get(b"revision") == revision.encode() and cached.remove_metadata().equals(TABLE_SCHEMA):
+            return pq.read_table(DATA_CACHE_PATH).cast(TABLE_SCHEMA)
+    except (OSError, ValueError, pa.ArrowInvalid):
+        pass
+    table = frame_to_table(fetch_sheet_data())
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"revision": revision.encode()})
+    try:
+        pq.write_table(table, DATA_CACHE_PATH, compression="zstd")
+    except Exception:
+        pass
+    return table
+
+def round_coords(coords, ndigits=5):
+    """Round a (nested) GeoJSON coordinate array; 5 decimals is ~1m"""
+    if isinstance(coords, (int, float)):
+        return round(coords, ndigits)
+    return [round_coords(c, ndigits) for c in coords]
+
+@st.cache_data(persist="disk", show_spinner=False)
+def fetch_geojson(url, tolerance=0.0005):
+    """Download a boundary GeoJSON once (kept on disk across restarts), simplify its polygons
+    (tolerance in degrees, ~50m) and round coordinates to 5 decimals"""
+    resp = requests.get(url, timeout=10)
+    resp.raise_for_status()
+    gj = orjson.loads(resp.content)
+    for feat in gj.get("features", []):
+        if feat.get("geometry"):
+            geom = mapping(shape(feat["geometry"]).simplify(tolerance, preserve_topology=True))
+            if "coordinates" in geom:
+                geom["coordinates"] = round_coords(geom["coordinates"])
+            feat["geometry"] = geom
+    return gj
+
+def make_row(name, lat, lng, sales, category, added_by):
+    return [name, float(lat), float(lng), float(sales), added_by, datetime.utcnow().isoformat(), category]
+
+def flush_pending_rows():
+    """Write every queued row to the sheet in a single values.append request"""
+    rows = st.session_state.pending_rows
+    # Revision from before the write: the written rows are shown locally until it moves on
+    revision = sheet_revision()
+    sheets_service.spreadsheets().values().append(
+        spreadsheetId=spreadsheet_id,
+        range=f"'{worksheet_title}'!A:G",
+        valueInputOption="RAW",
+        insertDataOption="INSERT_ROWS",
+        body={"values": rows}
+    ).execute()
+    if st.session_state.get("written_revision") != revision:
+        st.session_state.written_rows = []
+    st.session_state.written_rows = st.session_state.written_rows + rows
+    st.session_state.written_revision = revision
+    st.session_state.pending_rows = []
+
+if "pending_rows" not in st.session_state:
+    st.session_state.pending_rows = []
 
 # -----------------------------
 # SIDEBAR: ADD LOCATION
@@ -91,18 +269,37 @@ with st.sidebar.form("add_form", clear_on_submit=True):
         "Other"
     ])
     you = st.text_input("Your name", placeholder="optional")
-    submit = st.form_submit_button("Add to sheet")
+    submit = st.form_submit_button("Queue row")
 
 if submit:
     if not name or not lat or not lng or sales <= 0:
         st.sidebar.error("Please enter name, lat, lng, category, and positive sales.")
     else:
         try:
-            append_row(name, lat, lng, sales, category, you)
-            st.sidebar.success("Added! Press 'Refresh data' to see it.")
+            st.session_state.pending_rows.append(make_row(name, lat, lng, sales, category, you))
+            if len(st.session_state.pending_rows) >= PENDING_FLUSH_SIZE:
+                flush_pending_rows()
+                st.sidebar.success("Added!")
+            else:
+                st.sidebar.success("Queued! Press 'Flush to sheet' to save it.")
+        except Exception as e:
+            st.sidebar.error(f"Error: {e}")
+
+if st.session_state.pending_rows:
+    if st.sidebar.button(f"Flush to sheet ({len(st.session_state.pending_rows)} queued)", key="flush"):
+        try:
+            flush_pending_rows()
+            st.sidebar.success("Added!")
         except Exception as e:
             st.sidebar.error(f"Error: {e}")
 
+# Queued rows only live in this session, so keep saying so until they are written
+if st.session_state.pending_rows:
+    st.sidebar.warning(
+        f"{len(st.session_state.pending_rows)} row(s) not saved yet. "
+        "Press 'Flush to sheet' before closing the tab."
+    )
+
 # -----------------------------
 # REFRESH CONTROLS
 # -----------------------------
@@ -113,181 +310,409 @@ auto_refresh = col2.checkbox("Auto Refresh")
 if auto_refresh:
     refresh_interval = st.sidebar.slider("Interval (minutes)", 1, 30, 5)
 
-# Manual refresh
+# Manual refresh: re-check the revision now instead of waiting out REVISION_TTL
 if manual_refresh:
-    load_data.clear()
-    with st.spinner("Refreshing data..."):
-        st.session_state.df = load_data()
-    df = st.session_state.df
+    sheet_revision.clear()
 
 # Auto refresh
 if auto_refresh:
-    time.sleep(refresh_interval * 60)
-    load_data.clear()
-    st.session_state.df = load_data()
-    st.experimental_rerun()
+    # Browser-side timer; the count only changes when the timer (not a widget) triggered the rerun
+    refresh_count = st_autorefresh(interval=refresh_interval * 60_000, key="dref")
+    if refresh_count and refresh_count != st.session_state.get("last_refresh_count"):
+        st.session_state.last_refresh_count = refresh_count
+        sheet_revision.clear()
+
+# -----------------------------
+# LOAD DATA
+# -----------------------------
+# On a session's first run, download the boundary GeoJSON in the background
+# meanwhile so the map doesn't wait for it after the sheet
+with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as pool:
+    if "geojson_prefetched" not in st.session_state:
+        st.session_state.geojson_prefetched = True
+        for url in (CHICAGO_BOUNDARY_URL, NEIGHBORHOODS_URL):
+            pool.submit(fetch_geojson, url)
+    with st.spinner("Loading data..."):
+        revision = sheet_revision()
+        tbl = load_table(revision)
+
+# Rows this session just wrote are shown straight away instead of re-downloading the
+# sheet; once the revision moves past the write they are part of the loaded table
+if st.session_state.get("written_rows"):
+    if revision != st.session_state.written_revision:
+        st.session_state.written_rows = []
+    else:
+        written = frame_to_table(frame_from_values([SHEET_COLUMNS] + st.session_state.written_rows))
+        tbl = pa.concat_tables([tbl, written])
 
 # -----------------------------
 # FILTERING OPTIONS
 # -----------------------------
-if not df.empty:
+# Taken from the unfiltered table so filter choices don't shift the palette
+all_categories = []
+if tbl.num_rows:
+    # Filters are combined into one Arrow mask and applied with a single filter at the end;
+    # the shared table itself is never modified
+
     # Category filter
-    all_categories = sorted(df["Category"].dropna().unique())
+    all_categories = sorted(pc.unique(tbl["Category"]).drop_null().to_pylist())
     selected_categories = st.sidebar.multiselect(
         "Filter by Category", 
         options=all_categories, 
         default=all_categories
     )
-    df = df[df["Category"].isin(selected_categories)]
+    category_type = tbl.schema.field("Category").type
+    if pa.types.is_dictionary(category_type):
+        category_type = category_type.value_type
+    mask = pc.is_in(tbl["Category"], value_set=pa.array(selected_categories, type=category_type))
 
     # Sales range filter (rounded up to nearest 1000)
-    min_sales = int(df["Sales"].min())
-    max_sales = int(df["Sales"].max())
-    max_sales_rounded = int(math.ceil(max_sales / 1000.0) * 1000)
-
-    sales_range = st.sidebar.slider(
-        "Filter by Sales ($)",
-        min_value=min_sales,
-        max_value=max_sales_rounded,
-        value=(min_sales, max_sales_rounded),
-        step=1
-    )
-    df = df[(df["Sales"] >= sales_range[0]) & (df["Sales"] <= sales_range[1])]
+    sales_col = tbl["Sales"]
+    sales_stats = pc.min_max(pc.filter(sales_col, mask))
+    # Nothing is selected when every category is deselected; only the empty map is left to show
+    if sales_stats["min"].is_valid:
+        min_sales = int(sales_stats["min"].as_py())
+        max_sales = int(sales_stats["max"].as_py())
+        max_sales_rounded = int(math.ceil(max_sales / 1000.0) * 1000)
+
+        sales_range = st.sidebar.slider(
+            "Filter by Sales ($)",
+            min_value=min_sales,
+            max_value=max_sales_rounded,
+            value=(min_sales, max_sales_rounded),
+            step=1
+        )
+        mask = pc.and_kleene(mask, pc.and_kleene(
+            pc.greater_equal(sales_col, sales_range[0]),
+            pc.less_equal(sales_col, sales_range[1])
+        ))
+
+        # Time filter
+        if "Timestamp" in tbl.column_names:
+            ts_col = tbl["Timestamp"]
+            # Bounds come from ISO dates only: hand-typed text such as "N/A" sorts after them
+            is_iso = pc.match_substring_regex(ts_col, r"^\d{4}-\d{2}-\d{2}")
+            ts_stats = pc.min_max(pc.filter(ts_col, pc.and_kleene(mask, is_iso)))
+            # Even matching cells may not be real dates; skip the picker if the bounds don't parse
+            min_date = pd.to_datetime(ts_stats["min"].as_py(), errors="coerce")
+            max_date = pd.to_datetime(ts_stats["max"].as_py(), errors="coerce")
+            if not (pd.isna(min_date) or pd.isna(max_date)):
+                date_range = st.sidebar.date_input("Filter by Date Range", [min_date, max_date])
+                if isinstance(date_range, (list, tuple)) and len(date_range) == 2:
+                    # Bare dates sort before any time on that day; the end bound is the next day
+                    # (exclusive), so rows from the chosen last day are included
+                    start_iso = pd.Timestamp(date_range[0]).date().isoformat()
+                    end_iso = (pd.Timestamp(date_range[1]) + pd.Timedelta(days=1)).date().isoformat()
+                    mask = pc.and_kleene(mask, pc.and_kleene(
+                        pc.greater_equal(ts_col, pa.scalar(start_iso, type=ts_col.type)),
+                        pc.less(ts_col, pa.scalar(end_iso, type=ts_col.type))
+                    ))
+    else:
+        st.sidebar.info("No categories selected.")
+
+    tbl = tbl.filter(mask)
 
-    # Time filter
-    if "Timestamp" in df.columns and df["Timestamp"].notna().any():
-        min_date, max_date = df["Timestamp"].min(), df["Timestamp"].max()
-        date_range = st.sidebar.date_input("Filter by Date Range", [min_date, max_date])
-        if isinstance(date_range, list) and len(date_range) == 2:
-            start_date, end_date = pd.to_datetime(date_range[0]), pd.to_datetime(date_range[1])
-            df = df[(df["Timestamp"] >= start_date) & (df["Timestamp"] <= end_date)]
+# The only pandas copy is of the filtered rows this session displays
+df = tbl.to_pandas()
+
+# -----------------------------
+# CLUSTERED MARKER LAYER
+# -----------------------------
+# FastMarkerCluster builds every marker in the browser from one data array;
+# rows are [lat, lng, radius, color, popup_html]
+MARKER_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+        radius: row[2],
+        color: row[3],
+        fill: true,
+        fillOpacity: 0.7
+    });
+    marker.bindPopup(row[4], {maxWidth: 250});
+    return marker;
+}
+"""
+
+# -----------------------------
+# WEBGL SALES POINTS LAYER
+# -----------------------------
+class GlifyHeat(JSCSSMixin, folium.MacroElement):
+    """Leaflet.glify point layer coloured on a heat ramp, rasterized by WebGL"""
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }}_colors = {{ this.colors_json }};
+            var {{ this.get_name() }}_sizes = {{ this.sizes_json }};
+            var {{ this.get_name() }} = L.glify.points({
+                map: {{ this._map_name }},
+                data: {{ this.data_json }},
+                latitudeKey: 0,
+                longitudeKey: 1,
+                opacity: {{ this.opacity }},
+                size: function (i) { return {{ this.get_name() }}_sizes[i]; },
+                color: function (i) {
+                    var c = {{ this.get_name() }}_colors[i];
+                    return {r: c[0], g: c[1], b: c[2]};
+                }
+            });
+            {{ this._parent.get_name() }}.on("remove", function () { {{ this.get_name() }}.remove(); });
+        {% endmacro %}
+    """)
+
+    default_js = [("leaflet_glify", "https://unpkg.com/leaflet.glify/dist/glify-browser.js")]
+
+    # Same stops as Leaflet.heat's default gradient, as 0-1 RGB
+    GRADIENT = [(0.4, (0, 0, 1)), (0.6, (0, 1, 1)), (0.7, (0, 1, 0)), (0.8, (1, 1, 0)), (1.0, (1, 0, 0))]
+
+    def __init__(self, points, radius=15, opacity=0.6):
+        super().__init__()
+        self._name = "GlifyHeat"
+        weight = points[:, 2] / points[:, 2].max()
+        stops = [t for t, _ in self.GRADIENT]
+        colors = np.column_stack([
+            np.interp(weight, stops, [c[k] for _, c in self.GRADIENT]) for k in range(3)
+        ])
+        self.data_json = json.dumps(points[:, :2].tolist())
+        self.colors_json = json.dumps(colors.round(3).tolist())
+        self.sizes_json = json.dumps(np.maximum(4.0, weight * radius * 2).round(1).tolist())
+        self.opacity = opacity
+
+    def render(self, **kwargs):
+        # glify draws on the map itself, even when this layer lives inside a FeatureGroup
+        self._map_name = parent_map(self).get_name()
+        super().render(**kwargs)
+
+def parent_map(element):
+    """The folium.Map an element (possibly nested in a FeatureGroup) is attached to"""
+    parent = element._parent
+    while not isinstance(parent, folium.Map):
+        parent = parent._parent
+    return parent
+
+class MapPlugins(JSCSSMixin, folium.MacroElement):
+    """Loads the scripts of every data layer with the base map. st_folium keeps the component
+    mounted between reruns and only loads scripts on its first render, so a layer whose plugin
+    wasn't on the first map (Leaflet.heat after starting on Markers, say) would never draw"""
+    _template = Template("{% macro script(this, kwargs) %}{% endmacro %}")
+
+    default_js = FastMarkerCluster.default_js + HeatMap.default_js + GlifyHeat.default_js
+    default_css = FastMarkerCluster.default_css
+
+# -----------------------------
+# DYNAMIC LEGEND
+# -----------------------------
+class CategoryLegend(folium.MacroElement):
+    """Legend drawn as a Leaflet control from inside the data layer, so it is replaced along
+    with that layer instead of staying at its first-render contents in the page HTML"""
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.control({position: "bottomleft"});
+            {{ this.get_name() }}.onAdd = function () {
+                var div = L.DomUtil.create("div");
+                div.innerHTML = {{ this.html_json }};
+                return div;
+            };
+            // Shown and hidden with its layer, including from the layer control
+            {{ this._parent.get_name() }}.on("add", function () { {{ this.get_name() }}.addTo({{ this._map_name }}); });
+            {{ this._parent.get_name() }}.on("remove", function () { {{ this.get_name() }}.remove(); });
+        {% endmacro %}
+    """)
+
+    def __init__(self, legend):
+        super().__init__()
+        self._name = "CategoryLegend"
+        legend_items = "".join(f"""
+            <i style="background:{color}; width:12px; height:12px; 
+            float:left; margin-right:8px; opacity:0.7;"></i>{cat}<br>""" for cat, color in legend)
+
+        legend_html = f"""
+        <div style="
+            width: 220px; 
+            background-color: rgba(0, 0, 0, 0.6);
+            border-radius: 8px;
+            font-size:14px;
+            color: white;
+            padding: 10px;
+            line-height: 18px;
+        ">
+        <b>Category Legend</b><br>
+        {legend_items}
+        </div>
+        """
+        self.html_json = json.dumps(legend_html)
+
+    def render(self, **kwargs):
+        self._map_name = parent_map(self).get_name()
+        super().render(**kwargs)
 
 # -----------------------------
 # BUILD MAP
 # -----------------------------
-m = folium.Map(
-    location=[41.8781, -87.6298],
-    zoom_start=11,
-    tiles="CartoDB dark_matter",
-    attr="CartoDB Dark Matter"
-)
+def base_map():
+    """Tiles, boundary overlays and layer plugins from the cached GeoJSON. Built fresh each run:
+    st_folium mutates the map it is given, and identical maps render to the same component key anyway"""
+    m = folium.Map(
+        location=[41.8781, -87.6298],
+        zoom_start=11,
+        tiles="CartoDB dark_matter",
+        attr="CartoDB Dark Matter",
+        prefer_canvas=True
+    )
 
-try:
-    folium.GeoJson(
-        "https://data.cityofchicago.org/resource/ewy2-6yfk.geojson",
-        name="Chicago Boundary",
-        style_function=lambda x: {"color": "white", "weight": 2, "fillOpacity": 0}
-    ).add_to(m)
-except:
-    pass
-
-try:
-    folium.GeoJson(
-        "https://raw.githubusercontent.com/blackmad/neighborhoods/master/chicago.geojson",
-        name="Neighborhoods",
-        style_function=lambda x: {"color": "lightgray", "weight": 1, "fillOpacity": 0}
-    ).add_to(m)
-except:
-    pass
+    try:
+        folium.GeoJson(
+            fetch_geojson(CHICAGO_BOUNDARY_URL),
+            name="Chicago Boundary",
+            style_function=lambda x: {"color": "white", "weight": 2, "fillOpacity": 0}
+        ).add_to(m)
+    except:
+        pass
+
+    try:
+        folium.GeoJson(
+            fetch_geojson(NEIGHBORHOODS_URL),
+            name="Neighborhoods",
+            style_function=lambda x: {"color": "lightgray", "weight": 1, "fillOpacity": 0}
+        ).add_to(m)
+    except:
+        pass
+
+    MapPlugins().add_to(m)
+
+    folium.LayerControl(collapsed=True).add_to(m)
+    return m
 
 # -----------------------------
 # MAP VIEW OPTIONS
 # -----------------------------
-view_type = st.radio("Map view:", ["Markers", "Heatmap"], horizontal=True)
+# "Sales points (WebGL)" colours each location on the heat ramp and draws it on the GPU;
+# it is a separate view because it looks nothing like the Leaflet.heat heatmap
+view_type = st.radio("Map view:", ["Markers", "Heatmap", "Sales points (WebGL)"], horizontal=True)
 
-category_colors = {
+BASE_COLORS = {
     "Deli": "blue",
     "Grocery/Liquor Store": "green",
     "Hotel": "purple",
     "Restaurant/Cafe": "red",
     "Other": "orange"
 }
-color_cycle = itertools.cycle(["cadetblue","pink","darkred","darkblue","darkgreen","lightgray","black"])
-for cat in df["Category"].dropna().unique():
-    if cat not in category_colors:
-        category_colors[cat] = next(color_cycle)
+EXTRA_COLORS = ["cadetblue","pink","darkred","darkblue","darkgreen","lightgray","black"]
+
+@st.cache_data
+def resolve_palette(extra_cats):
+    """Base colours plus one cycled colour per extra category (pass them sorted so the result is stable)"""
+    palette = dict(BASE_COLORS)
+    palette.update(zip(extra_cats, itertools.cycle(EXTRA_COLORS)))
+    return palette
+
+category_colors = resolve_palette(tuple(sorted(set(all_categories) - BASE_COLORS.keys())))
+
+# Last viewport reported by the map component (empty until the first render)
+map_state = st.session_state.get("chicago_map") or {}
+
+# Markers doesn't report its viewport, so on leaving it the stored one is from before any
+# panning there. Ignore that snapshot until the map reports again, rather than prefiltering
+# to the old bounds
+if st.session_state.get("last_view_type") == "Markers" and view_type != "Markers":
+    st.session_state.stale_map_state = map_state
+st.session_state.last_view_type = view_type
+if view_type != "Markers" and map_state == st.session_state.get("stale_map_state"):
+    map_state = {}
+
+def viewport_mask(latlng, bounds, pad=0.5):
+    """Mask of points inside the map bounds, padded by a fraction of the view so small pans stay covered"""
+    try:
+        s, w = bounds["_southWest"]["lat"], bounds["_southWest"]["lng"]
+        n, e = bounds["_northEast"]["lat"], bounds["_northEast"]["lng"]
+    except (KeyError, TypeError):
+        s = w = n = e = None
+    if None in (s, w, n, e):
+        return np.ones(len(latlng), dtype=bool)
+    dlat, dlng = (n - s) * pad, (e - w) * pad
+    lat, lng = latlng[:, 0], latlng[:, 1]
+    return (lat >= s - dlat) & (lat <= n + dlat) & (lng >= w - dlng) & (lng <= e + dlng)
 
 # -----------------------------
 # ADD MARKERS OR HEATMAP
 # -----------------------------
-if not df.empty:
-    if view_type == "Markers":
-        for _, r in df.iterrows():
-            popup_html = f"""
-            <div style="font-size:14px">
-                <b>{r['Name']}</b><br>
-                Sales: ${r['Sales']}<br>
-                Category: {r.get('Category','Other')}<br>
-                {r.get('AddedBy','')}
-            </div>
-            """
-            folium.CircleMarker(
-                location=[r["Latitude"], r["Longitude"]],
-                radius=max(4, r["Sales"] / df["Sales"].max() * 15),
-                color=category_colors.get(r.get("Category","Other"), "gray"),
-                fill=True,
-                fill_opacity=0.7,
-                popup=folium.Popup(popup_html, max_width=250)
-            ).add_to(m)
-    else:
-        heat_data = df[["Latitude","Longitude","Sales"]].values.tolist()
-        HeatMap(heat_data, radius=15, blur=10, max_zoom=12).add_to(m)
+legend = tuple((cat, category_colors.get(cat, "gray")) for cat in df["Category"].dropna().unique())
+m = base_map()
 
-# -----------------------------
-# DYNAMIC LEGEND
-# -----------------------------
-def add_legend(map_obj, category_colors, df):
-    categories_present = df["Category"].dropna().unique()
-    legend_items = ""
-    for cat in categories_present:
-        color = category_colors.get(cat, "gray")
-        legend_items += f"""
-        <i style="background:{color}; width:12px; height:12px; 
-        float:left; margin-right:8px; opacity:0.7;"></i>{cat}<br>"""
-
-    legend_html = f"""
-    <div style="
-        position: fixed; 
-        bottom: 50px; left: 50px; width: 220px; 
-        background-color: rgba(0, 0, 0, 0.6);
-        border-radius: 8px;
-        z-index:9999; 
-        font-size:14px;
-        color: white;
-        padding: 10px;
-        line-height: 18px;
-    ">
-    <b>Category Legend</b><br>
-    {legend_items}
-    </div>
-    """
-    map_obj.get_root().html.add_child(folium.Element(legend_html))
+# Only this layer changes between reruns; while the base map renders identically, st_folium
+# swaps it in without redrawing the rest, so the legend lives here too
+fg = folium.FeatureGroup(name="Sales data")
+if legend:
+    fg.add_child(CategoryLegend(legend))
 
 if not df.empty:
-    add_legend(m, category_colors, df)
-
-folium.LayerControl(collapsed=True).add_to(m)
+    if view_type == "Markers":
+        # Round to 6 places (~0.1m) so coordinates serialize as short JSON numbers
+        latlng = df[["Latitude","Longitude"]].to_numpy(np.float64).round(6)
+        sales = df["Sales"].to_numpy(np.float32)
+        # Palette lookup by category code; the extra last entry catches unknown/missing categories
+        color_table = np.array(list(category_colors.values()) + ["gray"], dtype=object)
+        codes = df["Category"].astype("category").cat.set_categories(list(category_colors)).cat.codes.to_numpy()
+        colors = color_table[np.where(codes < 0, len(category_colors), codes)]
+        added = df["AddedBy"].fillna("").astype(str) if "AddedBy" in df.columns else ""
+        scale = np.float32(15.0) / sales.max()
+        radii = np.maximum(np.float32(4.0), sales * scale).tolist()
+        popups = (
+            '<div style="font-size:14px"><b>' + df["Name"].astype(str)
+            + "</b><br>Sales: $" + df["Sales"].astype(str)
+            + "<br>Category: " + df["Category"].astype(object).fillna("Other").astype(str)
+            + "<br>" + added + "</div>"
+        ).to_numpy(object)
+
+        marker_rows = [list(row) for row in zip(latlng[:, 0].tolist(), latlng[:, 1].tolist(), radii, colors, popups)]
+        FastMarkerCluster(marker_rows, callback=MARKER_CALLBACK, name="Locations").add_to(fg)
+    else:
+        points = df[["Latitude","Longitude","Sales"]].to_numpy(np.float64).round(6)
+        visible = viewport_mask(points[:, :2], map_state.get("bounds"))
+        if view_type == "Heatmap":
+            heat_data = points[visible].tolist()
+            HeatMap(heat_data, radius=15, blur=10, max_zoom=12).add_to(fg)
+        elif visible.any():
+            fg.add_child(GlifyHeat(points[visible], radius=15))
 
 # -----------------------------
 # STREAMLIT OUTPUT
 # -----------------------------
 st.markdown("### Chicago Sales Map")
-st_folium(m, width=1100, height=650)
+center = map_state.get("center")
+st_folium(
+    m,
+    width=1100,
+    height=650,
+    key="chicago_map",
+    feature_group_to_add=fg,
+    # The marker view is display-only, so panning it should not rerun the script;
+    # the other views need the viewport back to prefilter their points
+    returned_objects=["bounds", "center", "zoom"] if view_type != "Markers" else [],
+    center=(center["lat"], center["lng"]) if center else None,
+    zoom=map_state.get("zoom")
+)
 
 if not df.empty:
     st.markdown("### Summary by Category")
-    summary = df.groupby("Category").agg(
-        Locations=("Name", "count"),
+    summary = df.groupby("Category", observed=True, sort=False).agg(
+        Locations=("Name", "size"),
         Total_Sales=("Sales", "sum")
     ).reset_index()
     st.dataframe(summary)
 
 st.markdown("### Current Data")
-st.dataframe(df)
+n_show = len(df)
+if len(df) > DEFAULT_TABLE_ROWS:
+    n_show = st.number_input("Rows to display", min_value=1, max_value=len(df), value=DEFAULT_TABLE_ROWS, step=100)
+st.dataframe(df.head(n_show))
+
+@st.cache_data(max_entries=8)
+def df_to_csv_bytes(df):
+    """CSV export of the filtered data, re-encoded only when the data changes"""
+    return df.to_csv(index=False).encode("utf-8")
 
 st.download_button(
     "Download CSV",
-    data=df.to_csv(index=False).encode("utf-8"),
+    data=df_to_csv_bytes(df),
     file_name="chicago_sales.csv",
     mime="text/csv"
 )